@@ -1,16 +1,32 @@
 import asyncio
 import os
 import json
+import struct
 from bleak import BleakClient, BleakScanner
 import keyboard
 
 CONFIG_FILE = "ble_device_config.json"
 CHARACTERISTIC_UUID = "23408888-1f40-4cd8-9b89-ca8d45f8a5b0"  # Replace with your characteristic UUID
+ACK_EVERY = 10  # every Nth command waits for the car to acknowledge it, to catch a dropped link
+
+# speedA, speedB, directionA, directionB, duration packed into one reused
+# buffer; commands are sent one at a time, so it is never shared
+COMMAND_FORMAT = struct.Struct('<5B')
+command_buffer = bytearray(COMMAND_FORMAT.size)
+writes_since_ack = 0
 
 
 async def send_command(client, speedA, speedB, directionA, directionB, duration):
-    command = bytearray([speedA, speedB, directionA, directionB, duration])
-    await client.write_gatt_char(CHARACTERISTIC_UUID, command)
+    global writes_since_ack
+
+    COMMAND_FORMAT.pack_into(command_buffer, 0, speedA, speedB, directionA, directionB, duration)
+    # Write-without-response lets several commands go out in one connection
+    # interval instead of waiting for an ACK on each one
+    writes_since_ack += 1
+    response = writes_since_ack >= ACK_EVERY
+    if response:
+        writes_since_ack = 0
+    await client.write_gatt_char(CHARACTERISTIC_UUID, command_buffer, response=response)
 
 async def select_device():
     devices = await BleakScanner.discover()
@@ -58,23 +74,32 @@ async def get_ble_address():
         save_config(config)
     return new_address
 
-async def handle_key_press(client):
-
-    # motor A speed, motor A dir, motor B speed, motor B dir, time 50 == 5.0 seconds
-    if keyboard.is_pressed('w'):
-        await send_command(client, 60,1,60,1,5)
-        print(f"Forward")
-    elif keyboard.is_pressed('s'):
-        await send_command(client, 50,0,50,0,5)
-        print(f"Backwards")
-    elif keyboard.is_pressed('d'):
-        await send_command(client, 40,1,40,0,3)
-        print(f"Right")
-    elif keyboard.is_pressed('a'):
-        await send_command(client, 40,0,40,1,3)
-        print(f"Left")
-
-
+# motor A speed, motor A dir, motor B speed, motor B dir, time 50 == 5.0 seconds
+KEY_COMMANDS = {
+    'w': ((60, 1, 60, 1, 5), "Forward"),
+    's': ((50, 0, 50, 0, 5), "Backwards"),
+    'd': ((40, 1, 40, 0, 3), "Right"),
+    'a': ((40, 0, 40, 1, 3), "Left"),
+}
+
+def enqueue_command(queue, command):
+    # Runs on the event loop. At most one command waits to be sent and the
+    # newest key press replaces it, so held keys cannot build a backlog and a
+    # change of direction is never lost. A pending quit (None) is kept
+    while not queue.empty():
+        if queue.get_nowait() is None:
+            command = None
+    queue.put_nowait(command)
+
+async def send_queued_commands(client, queue):
+    while True:
+        command = await queue.get()
+        if command is None:
+            print("Quitting...")
+            return
+        args, name = command
+        await send_command(client, *args)
+        print(name)
 
 async def main():
     global motor_speed
@@ -89,11 +114,18 @@ async def main():
         print(f"Connected: {await client.is_connected()}")
         print("Press 'w' to speed up, 's' to slow down, or 'q' to quit.")
 
-        while True:
-            await handle_key_press(client)
-            if keyboard.is_pressed('q'):
-                print("Quitting...")
-                break
+        # keyboard invokes its callbacks on its own listener thread, so hand
+        # each key press over to the event loop instead of polling
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        for key, command in KEY_COMMANDS.items():
+            keyboard.on_press_key(key, lambda e, command=command: loop.call_soon_threadsafe(enqueue_command, queue, command))
+        keyboard.on_press_key('q', lambda e: loop.call_soon_threadsafe(enqueue_command, queue, None))
+
+        try:
+            await send_queued_commands(client, queue)
+        finally:
+            keyboard.unhook_all()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,107 +1,174 @@
 import numpy as np
-import re
-import struct
-from sklearn.utils import shuffle
+from scipy.linalg.blas import sgemm
 from sklearn.model_selection import train_test_split
 
 class NeuralNetwork:
-    def __init__(self, input_size, hidden_size1, hidden_size2, output_size):
+    def __init__(self, input_size, hidden_size1, hidden_size2, output_size, seed=42):
         self.input_size = input_size
         self.hidden_size1 = hidden_size1
         self.hidden_size2 = hidden_size2
         self.output_size = output_size
 
-        self.input_weights = np.random.randn(input_size, hidden_size1).astype(np.float32) * np.sqrt(2.0/input_size)
-        self.hidden_weights1 = np.random.randn(hidden_size1, hidden_size2).astype(np.float32) * np.sqrt(2.0/hidden_size1)
-        self.hidden_weights2 = np.random.randn(hidden_size2, output_size).astype(np.float32) * np.sqrt(2.0/hidden_size2)
+        self.rng = np.random.default_rng(seed)
+        self.input_weights = self.rng.standard_normal((input_size, hidden_size1), dtype=np.float32) * np.float32(np.sqrt(2.0/input_size))
+        self.hidden_weights1 = self.rng.standard_normal((hidden_size1, hidden_size2), dtype=np.float32) * np.float32(np.sqrt(2.0/hidden_size1))
+        self.hidden_weights2 = self.rng.standard_normal((hidden_size2, output_size), dtype=np.float32) * np.float32(np.sqrt(2.0/hidden_size2))
         self.hidden_bias1 = np.zeros((1, hidden_size1), dtype=np.float32)
         self.hidden_bias2 = np.zeros((1, hidden_size2), dtype=np.float32)
         self.output_bias = np.zeros((1, output_size), dtype=np.float32)
+        self.allocate_buffers(0)
 
     def relu(self, x):
         return np.maximum(0, x)
 
-    def relu_derivative(self, x):
-        return np.where(x > 0, 1, 0)
-
     def softmax(self, x):
-        exp_x = np.exp(x - np.max(x, axis=1, keepdims=True))
-        return exp_x / np.sum(exp_x, axis=1, keepdims=True)
-
-    def forward(self, X):
-        self.hidden1 = self.relu(np.dot(X, self.input_weights) + self.hidden_bias1)
-        self.hidden2 = self.relu(np.dot(self.hidden1, self.hidden_weights1) + self.hidden_bias2)
-        self.output = self.softmax(np.dot(self.hidden2, self.hidden_weights2) + self.output_bias)
-        return self.output
-
-    def backward(self, X, y, output, learning_rate):
-        output_error = y - output
-        hidden2_error = np.dot(output_error, self.hidden_weights2.T)
-        hidden1_error = np.dot(hidden2_error, self.hidden_weights1.T)
-
-        hidden2_delta = hidden2_error * self.relu_derivative(self.hidden2)
-        hidden1_delta = hidden1_error * self.relu_derivative(self.hidden1)
+        # Overwrites x, callers always pass a freshly computed logit array
+        x -= np.max(x, axis=1, keepdims=True)
+        np.exp(x, out=x)
+        x /= np.sum(x, axis=1, keepdims=True)
+        return x
 
-        self.hidden_weights2 += learning_rate * np.dot(self.hidden2.T, output_error)
-        self.hidden_weights1 += learning_rate * np.dot(self.hidden1.T, hidden2_delta)
-        self.input_weights += learning_rate * np.dot(X.T, hidden1_delta)
+    def cross_entropy(self, y, output):
+        return -np.sum(y * np.log(output + 1e-9)) / len(y)
 
-        self.output_bias += learning_rate * np.sum(output_error, axis=0, keepdims=True)
-        self.hidden_bias2 += learning_rate * np.sum(hidden2_delta, axis=0, keepdims=True)
-        self.hidden_bias1 += learning_rate * np.sum(hidden1_delta, axis=0, keepdims=True)
-
-    def train(self, X, y, X_val, y_val, epochs, learning_rate, batch_size=32, patience=50):
+    def forward(self, X):
+        hidden1 = self.relu(np.dot(X, self.input_weights) + self.hidden_bias1)
+        hidden2 = self.relu(np.dot(hidden1, self.hidden_weights1) + self.hidden_bias2)
+        return self.softmax(np.dot(hidden2, self.hidden_weights2) + self.output_bias)
+
+    def flat_parameters(self):
+        return np.concatenate([p.ravel() for p in (self.input_weights, self.hidden_weights1, self.hidden_weights2,
+                                                   self.hidden_bias1, self.hidden_bias2, self.output_bias)])
+
+    def allocate_buffers(self, batch_size):
+        # Reused by train_step; a short batch uses the leading rows
+        self.hidden1_buf = np.empty((batch_size, self.hidden_size1), dtype=np.float32)
+        self.hidden2_buf = np.empty((batch_size, self.hidden_size2), dtype=np.float32)
+        self.output_buf = np.empty((batch_size, self.output_size), dtype=np.float32)
+        self.mask1_buf = np.empty((batch_size, self.hidden_size1), dtype=bool)
+        self.mask2_buf = np.empty((batch_size, self.hidden_size2), dtype=bool)
+
+    def train_step(self, X, y, learning_rate):
+        # Forward pass, backward pass and weight update fused into one call
+        n = len(X)
+        if n > len(self.hidden1_buf):
+            self.allocate_buffers(n)
+        # np.dot(..., out=) needs operands matching the float32 buffers
+        X = np.asarray(X, dtype=np.float32)
+        y = np.asarray(y, dtype=np.float32)
+        hidden1 = np.dot(X, self.input_weights, out=self.hidden1_buf[:n])
+        hidden1 += self.hidden_bias1
+        np.maximum(hidden1, 0, out=hidden1)
+        # The ReLU masks double as the derivative in the backward pass
+        mask1 = np.greater(hidden1, 0, out=self.mask1_buf[:n])
+        hidden2 = np.dot(hidden1, self.hidden_weights1, out=self.hidden2_buf[:n])
+        hidden2 += self.hidden_bias2
+        np.maximum(hidden2, 0, out=hidden2)
+        mask2 = np.greater(hidden2, 0, out=self.mask2_buf[:n])
+        output = np.dot(hidden2, self.hidden_weights2, out=self.output_buf[:n])
+        output += self.output_bias
+        self.softmax(output)
+
+        # All gradients use the pre-update weights
+        hidden_weights2_t = np.ascontiguousarray(self.hidden_weights2.T)
+        hidden_weights1_t = np.ascontiguousarray(self.hidden_weights1.T)
+        # Softmax + cross-entropy gradient w.r.t. the logits, batch-averaged
+        output_delta = (output - y) / n
+        hidden2_error = np.dot(output_delta, hidden_weights2_t)
+        hidden2_delta = hidden2_error * mask2
+        hidden1_error = np.dot(hidden2_delta, hidden_weights1_t)
+        hidden1_delta = hidden1_error * mask1
+
+        # W.T is Fortran-ordered, so sgemm updates W in place
+        sgemm(-learning_rate, output_delta.T, hidden2.T, beta=1.0, c=self.hidden_weights2.T, trans_b=1, overwrite_c=1)
+        sgemm(-learning_rate, hidden2_delta.T, hidden1.T, beta=1.0, c=self.hidden_weights1.T, trans_b=1, overwrite_c=1)
+        sgemm(-learning_rate, hidden1_delta.T, X.T, beta=1.0, c=self.input_weights.T, trans_b=1, overwrite_c=1)
+
+        self.output_bias -= learning_rate * np.sum(output_delta, axis=0, keepdims=True)
+        self.hidden_bias2 -= learning_rate * np.sum(hidden2_delta, axis=0, keepdims=True)
+        self.hidden_bias1 -= learning_rate * np.sum(hidden1_delta, axis=0, keepdims=True)
+
+        return self.cross_entropy(y, output)
+
+    def train(self, X, y, X_val, y_val, epochs, learning_rate, batch_size=32, patience=50, val_every=10,
+              min_improvement=0.01, update_tol=5e-4, update_patience=20):
         best_val_loss = float('inf')
         patience_counter = 0
+        small_update_epochs = 0
+        X = np.asarray(X, dtype=np.float32)
+        y = np.asarray(y, dtype=np.float32)
+        # The out= matmuls and in-place SGEMM updates need C-contiguous float32
+        for name in ('input_weights', 'hidden_weights1', 'hidden_weights2', 'hidden_bias1', 'hidden_bias2', 'output_bias'):
+            setattr(self, name, np.ascontiguousarray(getattr(self, name), dtype=np.float32))
+        last_params = self.flat_parameters()
+        last_check = -1
+        n_batches = -(-len(X) // batch_size)
         for epoch in range(epochs):
             epoch_loss = 0
+            # Reshuffle every epoch so the mini-batches differ each pass
+            perm = self.rng.permutation(len(X))
+            X_shuffled, y_shuffled = X[perm], y[perm]
             for i in range(0, len(X), batch_size):
-                batch_X = X[i:i+batch_size]
-                batch_y = y[i:i+batch_size]
-                output = self.forward(batch_X)
-                self.backward(batch_X, batch_y, output, learning_rate)
-                epoch_loss += np.mean(np.square(batch_y - output))
+                epoch_loss += self.train_step(X_shuffled[i:i+batch_size], y_shuffled[i:i+batch_size], learning_rate)
+
+            # Validate every val_every epochs; patience is still in epochs
+            if epoch % val_every != 0:
+                continue
+
+            # Per-epoch relative weight change since the last check
+            params = self.flat_parameters()
+            self.update_norm = np.linalg.norm(params - last_params) / np.linalg.norm(params) / (epoch - last_check)
+            last_params, last_check = params, epoch
+            if self.update_norm < update_tol:
+                small_update_epochs += val_every
+                if small_update_epochs >= update_patience:
+                    print(f"Early stopping at epoch {epoch}, update norm {self.update_norm}")
+                    break
+            else:
+                small_update_epochs = 0
 
             val_output = self.forward(X_val)
-            val_loss = np.mean(np.square(y_val - val_output))
+            val_loss = self.cross_entropy(y_val, val_output)
 
             if epoch % 100 == 0:
-                print(f"Epoch {epoch}, Loss: {epoch_loss/len(X)}, Val Loss: {val_loss}")
+                print(f"Epoch {epoch}, Loss: {epoch_loss/n_batches}, Val Loss: {val_loss}")
 
-            if val_loss < best_val_loss:
+            # Only a relative improvement of at least min_improvement resets patience
+            if val_loss < (1 - min_improvement) * best_val_loss:
                 best_val_loss = val_loss
                 patience_counter = 0
             else:
-                patience_counter += 1
+                patience_counter += val_every
                 if patience_counter >= patience:
                     print(f"Early stopping at epoch {epoch}")
                     break
 
 def parse_input(file_path):
-    data = []
-    labels = []
-    with open(file_path, 'r') as file:
-        for line in file:
-            match = re.search(r'Red: (\d+), Green: (\d+), Blue: (\d+), Clear: (\d+), Color: (\w+)', line)
-            if match:
-                r, g, b, c, color = match.groups()
-                data.append([int(r), int(g), int(b), int(c)])
-                labels.append(color)
-    return np.array(data), np.array(labels)
+    dt = np.dtype([('r', 'i4'), ('g', 'i4'), ('b', 'i4'), ('c', 'i4'), ('color', 'U8')])
+    arr = np.fromregex(file_path, r'Red: (\d+), Green: (\d+), Blue: (\d+), Clear: (\d+), Color: (\w+)', dt)
+    data = np.stack([arr['r'], arr['g'], arr['b'], arr['c']], axis=1)
+    return data, arr['color']
 
 def normalize_data(data):
-    return data / np.array([2048, 2048, 2048, 2048])
+    return data.astype(np.float32) * np.float32(1.0 / 2048.0)
 
 def one_hot_encode(labels):
+    # Order matches color_names[] in neural_net_predictor.c, so it is unsorted
     unique_labels = np.array(['Red', 'Black', 'Green', 'White'])
-    label_dict = {label: i for i, label in enumerate(unique_labels)}
-    encoded = np.zeros((len(labels), len(unique_labels)))
-    for i, label in enumerate(labels):
-        encoded[i, label_dict[label]] = 1
+    order = np.argsort(unique_labels)
+    pos = np.searchsorted(unique_labels, labels, sorter=order)
+    idx = order[np.minimum(pos, len(unique_labels) - 1)]
+    # searchsorted maps unknown labels (e.g. Blue) onto a neighbouring class
+    unknown = unique_labels[idx] != labels
+    if np.any(unknown):
+        raise ValueError(f"Unknown color labels: {np.unique(labels[unknown]).tolist()}")
+    encoded = np.eye(len(unique_labels), dtype=np.float32)[idx]
     return encoded, unique_labels
 
-def float_to_hex(f):
-    return hex(struct.unpack('<I', struct.pack('<f', f))[0])
+def floats_to_hex(a):
+    # Reinterpret the float32 bits as uint32 and format them all in one call
+    bits = np.ascontiguousarray(a, dtype=np.float32).view(np.uint32)
+    return ", ".join(np.char.mod('0x%08x', bits).ravel())
 
 # Prepare training data
 input_data, labels = parse_input('color_data.txt')
@@ -113,28 +180,28 @@ X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, random_st
 
 # Create and train the neural network
 nn = NeuralNetwork(input_size=4, hidden_size1=16, hidden_size2=8, output_size=4)
-nn.train(X_train, y_train, X_val, y_val, epochs=10000, learning_rate=0.001, batch_size=32, patience=50)
+nn.train(X_train, y_train, X_val, y_val, epochs=10000, learning_rate=0.032, batch_size=32, patience=50)
 
 # Print C-compatible array initializers
 print("\nC-compatible array initializers:")
 print("uint32_t input_weights[INPUT_SIZE][HIDDEN_SIZE1] = {")
 for row in nn.input_weights:
-    print("    {" + ", ".join(float_to_hex(x) for x in row) + "},")
+    print("    {" + floats_to_hex(row) + "},")
 print("};")
 
 print("\nuint32_t hidden_weights1[HIDDEN_SIZE1][HIDDEN_SIZE2] = {")
 for row in nn.hidden_weights1:
-    print("    {" + ", ".join(float_to_hex(x) for x in row) + "},")
+    print("    {" + floats_to_hex(row) + "},")
 print("};")
 
 print("\nuint32_t hidden_weights2[HIDDEN_SIZE2][OUTPUT_SIZE] = {")
 for row in nn.hidden_weights2:
-    print("    {" + ", ".join(float_to_hex(x) for x in row) + "},")
+    print("    {" + floats_to_hex(row) + "},")
 print("};")
 
-print("\nuint32_t hidden_bias1[HIDDEN_SIZE1] = {" + ", ".join(float_to_hex(x) for x in nn.hidden_bias1.flatten()) + "};")
-print("\nuint32_t hidden_bias2[HIDDEN_SIZE2] = {" + ", ".join(float_to_hex(x) for x in nn.hidden_bias2.flatten()) + "};")
-print("\nuint32_t output_bias[OUTPUT_SIZE] = {" + ", ".join(float_to_hex(x) for x in nn.output_bias.flatten()) + "};")
+print("\nuint32_t hidden_bias1[HIDDEN_SIZE1] = {" + floats_to_hex(nn.hidden_bias1) + "};")
+print("\nuint32_t hidden_bias2[HIDDEN_SIZE2] = {" + floats_to_hex(nn.hidden_bias2) + "};")
+print("\nuint32_t output_bias[OUTPUT_SIZE] = {" + floats_to_hex(nn.output_bias) + "};")
 
 # Debug information
 print("\nSample predictions from Python:")